@@ -1,43 +1,137 @@
+import asyncio
+import hashlib
 import logging
 import os
 import re
 import shutil
-import json
+import orjson
+from functools import lru_cache
 from pathlib import Path
 
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from starlette.exceptions import HTTPException
 from typing import Optional
 
 from api.models.area import AreaConfigDTO, AreasListDTO
 from constants import ALL_AREAS
-from .cameras import map_camera, get_cameras
 from api.models.occupancy_rule import OccupancyRuleListDTO
 from libs.utils import config as config_utils
 from api.utils import (
-    extract_config, get_config, handle_response, reestructure_areas, update_config, map_section_from_config,
-    map_to_config_file_format, bad_request_serializer
+    extract_config, get_config, handle_response, remove_area, update_config, map_section_from_config,
+    map_to_config_file_format, bad_request_serializer, config_cache_key, config_is_stale,
+    AREA_SECTION_PREFIX, SOURCE_SECTION_PREFIX
 )
 
 areas_router = APIRouter()
 
+# Bumped whenever the API writes the areas' json files (occupancy rules, settings of the area "ALL").
+_area_files_version = 0
+# Serializes the read-modify-writes of ALL.json, which holds both the settings and the rules of the area "ALL".
+_area_all_file_lock = None
+# Contents and ETags served by the GET endpoints, valid while the config and the area files are unchanged.
+_area_responses = (None, {})
 
-def get_areas():
-    config = extract_config(config_type="areas")
+
+def _get_area_all_file_lock():
+    global _area_all_file_lock
+    # Created on first use so it belongs to the running event loop
+    if _area_all_file_lock is None:
+        _area_all_file_lock = asyncio.Lock()
+    return _area_all_file_lock
+
+
+@lru_cache(maxsize=1)
+def _get_areas(cache_key):
+    # The caller already resolved <cache_key>, so serve the snapshot it was resolved from
+    config = extract_config(config_type="areas", allow_stale=True)
     return [map_section_from_config(x, config) for x in config.keys()]
 
 
+@lru_cache(maxsize=1)
+def _get_areas_by_id(cache_key):
+    return {area["id"]: area for area in _get_areas(cache_key)}
+
+
+def is_area_all(area_id: str):
+    # Only ids of the same length can match, skip allocating an uppercase copy for every other id
+    return len(area_id) == len(ALL_AREAS) and (area_id == ALL_AREAS or area_id.upper() == ALL_AREAS)
+
+
+def get_areas(allow_stale=False):
+    return [dict(area) for area in _get_areas(config_cache_key(allow_stale))]
+
+
+def get_area_by_id(area_id, allow_stale=False):
+    area = _get_areas_by_id(config_cache_key(allow_stale)).get(area_id)
+    return dict(area) if area else None
+
+
+@lru_cache(maxsize=1)
+def _get_all_cameras_ids(cache_key):
+    return ",".join(camera["Id"] for camera in extract_config(config_type="cameras", allow_stale=True).values())
+
+
+def get_all_cameras_ids(allow_stale=False):
+    return _get_all_cameras_ids(config_cache_key(allow_stale))
+
+
+def extract_areas_config():
+    """
+    Extracts the config once and indexes what the area mutations need: the areas by config section (Area_<n>),
+    the ids of the cameras and the config section of each area id.
+    """
+    config_dict = extract_config()
+    areas_by_section = {}
+    camera_ids = set()
+    for section_name, section in config_dict.items():
+        if section_name.startswith(AREA_SECTION_PREFIX):
+            areas_by_section[section_name] = map_section_from_config(section_name, config_dict)
+        elif section_name.startswith(SOURCE_SECTION_PREFIX):
+            camera_ids.add(section["Id"])
+    area_section_by_id = {area["id"]: section_name for section_name, area in areas_by_section.items()}
+    return config_dict, areas_by_section, camera_ids, area_section_by_id
+
+
+async def _cached_area_response(request: Request, response: Response, resource_key: str, build_content):
+    """
+    Serves the content built by <build_content> from memory until the config or the area files change. The
+    ETag is a hash of the content, so clients can revalidate with If-None-Match and get a 304 if unchanged.
+    """
+    global _area_responses
+    generation = (config_cache_key(allow_stale=True), _area_files_version)
+    cached_generation, responses = _area_responses
+    if cached_generation != generation:
+        responses = {}
+        _area_responses = (generation, responses)
+    if resource_key not in responses:
+        content = await build_content()
+        etag = '"' + hashlib.blake2b(orjson.dumps(jsonable_encoder(content)), digest_size=8).hexdigest() + '"'
+        responses[resource_key] = (etag, content)
+    etag, content = responses[resource_key]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if config_is_stale():
+        response.headers["Warning"] = '110 - "Response is Stale"'
+    return content
+
+
 @areas_router.get("", response_model=AreasListDTO)
-async def list_areas():
+async def list_areas(request: Request, response: Response):
     """
     Returns the list of areas managed by the processor.
     """
-    return {
-        "areas": get_areas()
-    }
+    async def build_content():
+        return {
+            "areas": get_areas(allow_stale=True)
+        }
+    return await _cached_area_response(request, response, "", build_content)
 
 
-def area_all_data():
+def area_all_data(allow_stale=False):
     config = get_config()
     area_all = config.get_area_all()
 
@@ -54,22 +148,26 @@ def area_all_data():
         "occupancy_threshold": area_all.occupancy_threshold,
         "id": area_all.id,
         "name": area_all.name,
-        "cameras": ",".join(area_all.cameras)
+        "cameras": get_all_cameras_ids(allow_stale)
     }
 
 
 @areas_router.get("/{area_id}", response_model=AreaConfigDTO)
-async def get_area(area_id: str):
+async def get_area(area_id: str, request: Request, response: Response):
     """
     Returns the configuration related to the area <area_id>
     """
-    if area_id.upper() == ALL_AREAS:
-        area = area_all_data()
+    return await _cached_area_response(request, response, area_id, lambda: _get_area(area_id))
+
+
+async def _get_area(area_id: str):
+    if is_area_all(area_id):
+        area = area_all_data(allow_stale=True)
     else:
-        area = next((area for area in get_areas() if area["id"] == area_id), None)
+        area = get_area_by_id(area_id, allow_stale=True)
         if not area:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"The area: {area_id} does not exist")
-    area["occupancy_rules"] = get_area_occupancy_rules(area["id"])
+    area["occupancy_rules"] = await _load_area_occupancy_rules(area["id"])
     return area
 
 
@@ -79,45 +177,44 @@ async def create_area(new_area: AreaConfigDTO, reboot_processor: Optional[bool]
     Adds a new area to the processor.
     """
     # TODO: We have to autogenerate the ID.
-    config = get_config()
-    areas = config.get_areas()
-    if new_area.id in [area.id for area in areas]:
+    config_dict, areas_by_section, camera_ids, area_section_by_id = extract_areas_config()
+    if new_area.id in area_section_by_id:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=bad_request_serializer("Area already exists", error_type="config duplicated area")
         )
-    elif new_area.id.upper() == ALL_AREAS:
+    elif is_area_all(new_area.id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=bad_request_serializer("Area with ID: 'ALL' is not valid.", error_type="Invalid ID")
         )
 
-    cameras = config.get_video_sources()
-    camera_ids = [camera.id for camera in cameras]
-    if not all(x in camera_ids for x in new_area.cameras.split(",")):
-        non_existent_cameras = set(new_area.cameras.split(",")) - set(camera_ids)
+    non_existent_cameras = set(new_area.cameras.split(",")) - camera_ids
+    if non_existent_cameras:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"The cameras: {non_existent_cameras} do not exist")
     occupancy_rules = new_area.occupancy_rules
     del new_area.occupancy_rules
     area_dict = map_to_config_file_format(new_area)
 
-    config_dict = extract_config()
-    config_dict[f"Area_{len(areas)-1}"] = area_dict
+    # Count sections rather than ids, a hand-edited config may repeat an id
+    area_index = len(areas_by_section)
+    while f"{AREA_SECTION_PREFIX}{area_index}" in config_dict:
+        area_index += 1
+    area_section = f"{AREA_SECTION_PREFIX}{area_index}"
+    config_dict[area_section] = area_dict
     success = update_config(config_dict, reboot_processor)
 
     if occupancy_rules:
-        set_occupancy_rules(new_area.id, occupancy_rules)
+        await set_occupancy_rules(new_area.id, occupancy_rules)
 
     if not success:
         return handle_response(area_dict, success, status.HTTP_201_CREATED)
 
-    area_directory = os.path.join(os.getenv("AreaLogDirectory"), new_area.id, "occupancy_log")
-    Path(area_directory).mkdir(parents=True, exist_ok=True)
-    area_config_directory = os.path.join(os.getenv("AreaConfigDirectory"), new_area.id)
-    Path(area_config_directory).mkdir(parents=True, exist_ok=True)
+    await run_in_threadpool(_create_area_directories, new_area.id)
 
-    # known issue: Occupancy rules not returned
-    return next((area for area in get_areas() if area["id"] == area_dict["Id"]), None)
+    area = map_section_from_config(area_section, config_dict)
+    area["occupancy_rules"] = list(occupancy_rules) if occupancy_rules else []
+    return area
 
 
 def modify_area_all(area_information):
@@ -141,21 +238,15 @@ def modify_area_all(area_information):
         }
     }
 
-    if not os.path.exists(config_path):
-        # Create the file with if necessary
-        with open(config_path, 'x') as outfile:
-            json.dump({"global_area_all": {}}, outfile)
-
-    with open(config_path, "r") as file:
-        file_content = json.load(file)
+    file_content = {}
+    if os.path.exists(config_path):
+        with open(config_path, "rb") as file:
+            file_content = orjson.loads(file.read())
 
     file_content["global_area_all"] = json_content["global_area_all"]
+    _write_area_config_file(config_path, file_content)
 
-    with open(config_path, "w") as file:
-        json.dump(file_content, file)
-
-    area_all = config.get_area_all()
-    json_content["global_area_all"]["Cameras"] = ",".join(area_all.cameras)
+    json_content["global_area_all"]["Cameras"] = get_all_cameras_ids()
 
     return {re.sub(r'(?<!^)(?=[A-Z])', '_', key).lower(): value for key, value in json_content["global_area_all"].items()}
 
@@ -165,30 +256,27 @@ async def edit_area(area_id: str, edited_area: AreaConfigDTO, reboot_processor:
     """
     Edits the configuration related to the area <area_id>
     """
-    if area_id.upper() == ALL_AREAS:
-        area = modify_area_all(edited_area)
-        if edited_area.occupancy_rules:
-            set_occupancy_rules(ALL_AREAS, edited_area.occupancy_rules)
-        else:
-            delete_area_occupancy_rules(ALL_AREAS)
-        area["occupancy_rules"] = get_area_occupancy_rules(ALL_AREAS)
+    global _area_files_version
+    if is_area_all(area_id):
+        async with _get_area_all_file_lock():
+            area = await run_in_threadpool(modify_area_all, edited_area)
+            # Bumped here rather than in the worker thread, the counter is only updated from the event loop
+            _area_files_version += 1
+            if edited_area.occupancy_rules:
+                await set_occupancy_rules(ALL_AREAS, edited_area.occupancy_rules)
+            else:
+                await delete_area_occupancy_rules(ALL_AREAS)
+            area["occupancy_rules"] = await get_area_occupancy_rules(ALL_AREAS)
         return area
 
     edited_area.id = area_id
-    config_dict = extract_config()
-    area_names = [x for x in config_dict.keys() if x.startswith("Area_")]
-    areas = [map_section_from_config(x, config_dict) for x in area_names]
-    areas_ids = [area["id"] for area in areas]
-    try:
-        index = areas_ids.index(area_id)
-    except ValueError:
+    config_dict, _, camera_ids, area_section_by_id = extract_areas_config()
+    area_section = area_section_by_id.get(area_id)
+    if area_section is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"The area: {area_id} does not exist")
 
-    cameras = [x for x in config_dict.keys() if x.startswith("Source_")]
-    cameras = [map_camera(x, config_dict, []) for x in cameras]
-    camera_ids = [camera["id"] for camera in cameras]
-    if not all(x in camera_ids for x in edited_area.cameras.split(",")):
-        non_existent_cameras = set(edited_area.cameras.split(",")) - set(camera_ids)
+    non_existent_cameras = set(edited_area.cameras.split(",")) - camera_ids
+    if non_existent_cameras:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"The cameras: {non_existent_cameras}"
                                                                           f"do not exist")
 
@@ -196,18 +284,18 @@ async def edit_area(area_id: str, edited_area: AreaConfigDTO, reboot_processor:
     del edited_area.occupancy_rules
 
     area_dict = map_to_config_file_format(edited_area)
-    config_dict[f"Area_{index}"] = area_dict
+    config_dict[area_section] = area_dict
     success = update_config(config_dict, reboot_processor)
 
     if occupancy_rules:
-        set_occupancy_rules(edited_area.id, occupancy_rules)
+        await set_occupancy_rules(edited_area.id, occupancy_rules)
     else:
-        delete_area_occupancy_rules(area_id)
+        await delete_area_occupancy_rules(area_id)
 
     if not success:
         return handle_response(area_dict, success)
-    area = next((area for area in get_areas() if area["id"] == area_id), None)
-    area["occupancy_rules"] = get_area_occupancy_rules(area["id"])
+    area = map_section_from_config(area_section, config_dict)
+    area["occupancy_rules"] = list(occupancy_rules) if occupancy_rules else []
     return area
 
 
@@ -216,80 +304,156 @@ async def delete_area(area_id: str, reboot_processor: Optional[bool] = True):
     """
     Deletes the configuration related to the area <area_id>
     """
-    if area_id.upper() == ALL_AREAS:
-        delete_area_occupancy_rules(ALL_AREAS)
+    if is_area_all(area_id):
+        async with _get_area_all_file_lock():
+            await delete_area_occupancy_rules(ALL_AREAS)
         raise HTTPException(
             status_code=status.HTTP_202_ACCEPTED,
             detail="Area with ID: 'ALL' cannot be deleted. However, its occupancy rules were deleted."
         )
-    config_dict = extract_config()
-    areas_name = [x for x in config_dict.keys() if x.startswith("Area_")]
-    areas = [map_section_from_config(x, config_dict) for x in areas_name]
-    areas_ids = [area["id"] for area in areas]
-    try:
-        index = areas_ids.index(area_id)
-    except ValueError:
+    config_dict, _, _, area_section_by_id = extract_areas_config()
+    area_section = area_section_by_id.get(area_id)
+    if area_section is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"The area: {area_id} does not exist")
 
-    config_dict.pop(f"Area_{index}")
-    config_dict = reestructure_areas(config_dict)
+    config_dict = remove_area(config_dict, area_section)
 
     success = update_config(config_dict, reboot_processor)
 
-    delete_area_occupancy_rules(area_id)
+    await delete_area_occupancy_rules(area_id)
+
+    await run_in_threadpool(_delete_area_directories, area_id)
+
+    return handle_response(None, success, status.HTTP_204_NO_CONTENT)
 
+
+def _create_area_directories(area_id: str):
+    area_directory = os.path.join(os.getenv("AreaLogDirectory"), area_id, "occupancy_log")
+    Path(area_directory).mkdir(parents=True, exist_ok=True)
+    area_config_directory = os.path.join(os.getenv("AreaConfigDirectory"), area_id)
+    Path(area_config_directory).mkdir(parents=True, exist_ok=True)
+
+
+def _delete_area_directories(area_id: str):
     area_directory = os.path.join(os.getenv("AreaLogDirectory"), area_id)
     shutil.rmtree(area_directory)
     area_config_directory = os.path.join(os.getenv("AreaConfigDirectory"), area_id)
     shutil.rmtree(area_config_directory)
 
-    return handle_response(None, success, status.HTTP_204_NO_CONTENT)
+
+# Occupancy rules waiting to be written and the task writing them, by area id. Rules set while a write for the
+# same area is in progress are collapsed into a single write of the latest value.
+_pending_occupancy_rules = {}
+_occupancy_rules_writers = {}
 
 
-def get_area_occupancy_rules(area_id: str):
+async def get_area_occupancy_rules(area_id: str):
     """
     Returns time-based occupancy rules for an area.
     """
-    config = get_config()
-    areas = config.get_areas()
-    area = next((area for area in areas if area.id == area_id), None)
-    if not area:
+    if area_id != ALL_AREAS and area_id not in _get_areas_by_id(config_cache_key()):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"The area: {area_id} does not exist")
-    area_config_path = area.get_config_path()
+    return await _load_area_occupancy_rules(area_id)
+
+
+async def _load_area_occupancy_rules(area_id: str):
+    # The caller already checked that the area exists
+    if area_id in _pending_occupancy_rules:
+        return list(_pending_occupancy_rules[area_id])
+    area_config_path = get_config().get_area_config_path(area_id)
+    return await run_in_threadpool(_load_occupancy_rules, area_config_path)
+
+
+async def set_occupancy_rules(area_id: str, rules):
+    global _area_files_version
+    _area_files_version += 1
+    _pending_occupancy_rules[area_id] = rules
+    writer = _occupancy_rules_writers.get(area_id)
+    if writer is None:
+        writer = asyncio.ensure_future(_write_pending_occupancy_rules(area_id))
+        _occupancy_rules_writers[area_id] = writer
+    await asyncio.shield(writer)
+
+
+async def delete_area_occupancy_rules(area_id: str):
+    global _area_files_version
+    _pending_occupancy_rules.pop(area_id, None)
+    writer = _occupancy_rules_writers.get(area_id)
+    if writer is not None:
+        # Let the write in progress finish so it can't restore the rules after they are deleted
+        await asyncio.wait([writer])
+    try:
+        return await run_in_threadpool(_delete_area_occupancy_rules, area_id)
+    finally:
+        _area_files_version += 1
+
 
+async def _write_pending_occupancy_rules(area_id: str):
+    try:
+        while area_id in _pending_occupancy_rules:
+            rules = _pending_occupancy_rules[area_id]
+            await run_in_threadpool(_set_occupancy_rules, area_id, rules)
+            if _pending_occupancy_rules.get(area_id) is rules:
+                del _pending_occupancy_rules[area_id]
+    except Exception:
+        _pending_occupancy_rules.pop(area_id, None)
+        raise
+    finally:
+        del _occupancy_rules_writers[area_id]
+
+
+def _load_occupancy_rules(area_config_path: str):
     if not os.path.exists(area_config_path):
         return []
 
-    with open(area_config_path, "r") as area_file:
-        rules_data = json.load(area_file)
+    with open(area_config_path, "rb") as area_file:
+        rules_data = orjson.loads(area_file.read())
     return OccupancyRuleListDTO.from_store_json(rules_data)
 
 
-def set_occupancy_rules(area_id: str, rules):
+def _set_occupancy_rules(area_id: str, rules):
     area_config_path = get_config().get_area_config_path(area_id)
     Path(os.path.dirname(area_config_path)).mkdir(parents=True, exist_ok=True)
 
-    if os.path.exists(area_config_path):
-        with open(area_config_path, "r") as area_file:
-            data = json.load(area_file)
-    else:
-        data = {}
+    data = {}
+    if area_id == ALL_AREAS and os.path.exists(area_config_path):
+        # The file of the area "ALL" also stores its notification settings, the rest only store the rules
+        with open(area_config_path, "rb") as area_file:
+            data = orjson.loads(area_file.read())
 
-    with open(area_config_path, "w") as area_file:
-        data["occupancy_rules"] = rules.to_store_json()["occupancy_rules"]
-        json.dump(data, area_file)
+    data["occupancy_rules"] = rules.to_store_json()["occupancy_rules"]
+    _write_area_config_file(area_config_path, data)
 
 
-def delete_area_occupancy_rules(area_id: str):
+def _delete_area_occupancy_rules(area_id: str):
     area_config_path = get_config().get_area_config_path(area_id)
 
-    if os.path.exists(area_config_path):
-        with open(area_config_path, "r") as area_file:
-            data = json.load(area_file)
-    else:
+    if area_id != ALL_AREAS:
+        # Regular areas without rules have no file, so there is nothing to delete
+        if os.path.exists(area_config_path):
+            os.remove(area_config_path)
+        return
+
+    if not os.path.exists(area_config_path):
         return handle_response(None, False)
 
-    with open(area_config_path, "w") as area_file:
-        if data.get("occupancy_rules") is not None:
-            del data["occupancy_rules"]
-        json.dump(data, area_file)
+    with open(area_config_path, "rb") as area_file:
+        data = orjson.loads(area_file.read())
+    if data.get("occupancy_rules") is not None:
+        del data["occupancy_rules"]
+    _write_area_config_file(area_config_path, data)
+
+
+def _write_area_config_file(area_config_path: str, data: dict):
+    """
+    Replaces the file atomically, so the processor never reads a partially written file.
+    """
+    tmp_path = f"{area_config_path}.tmp"
+    try:
+        with open(tmp_path, "wb") as area_file:
+            area_file.write(orjson.dumps(data))
+        os.replace(tmp_path, area_config_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
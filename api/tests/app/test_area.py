@@ -0,0 +1,115 @@
+import pytest
+from copy import deepcopy
+
+from api import utils
+from api.utils import extract_config, get_config, remove_area
+
+# The line below is absolutely necessary. Fixtures are passed as arguments to test functions. That is why IDE could
+# not recognized them.
+from api.tests.utils.fixtures_tests import config_rollback_areas, rollback_area_config_path
+
+
+# pytest -v api/tests/app/test_area.py::TestsAreaResponseCache
+class TestsAreaResponseCache:
+    """ Get Areas, GET /areas """
+    """ Get Area, GET /areas/:id """
+
+    def test_list_areas_not_modified(self, config_rollback_areas):
+        area, area_2, client, config_sample_path = config_rollback_areas
+
+        response = client.get("/areas")
+        etag = response.headers["ETag"]
+        cached_response = client.get("/areas", headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert cached_response.status_code == 304
+        assert cached_response.headers["ETag"] == etag
+
+    def test_get_area_etag_changes_after_edit(self, config_rollback_areas, rollback_area_config_path):
+        area, area_2, client, config_sample_path = config_rollback_areas
+        area_id = area["id"]
+
+        response = client.get(f"/areas/{area_id}")
+        etag = response.headers["ETag"]
+        data = deepcopy(area)
+        data["name"] = "Living room"
+        data["occupancy_rules"] = [{
+            "days": [True, True, False, False, False, True, True],
+            "start_hour": "08:00",
+            "finish_hour": "12:00",
+            "max_occupancy": 10
+        }]
+        put_response = client.put(f"/areas/{area_id}", json=data)
+        edited_response = client.get(f"/areas/{area_id}", headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert put_response.status_code == 200
+        assert edited_response.status_code == 200
+        assert edited_response.headers["ETag"] != etag
+        assert edited_response.json()["name"] == "Living room"
+
+    def test_list_areas_stale_when_config_cant_be_read(self, config_rollback_areas, monkeypatch):
+        area, area_2, client, config_sample_path = config_rollback_areas
+
+        response = client.get("/areas")
+
+        def failing_get_section_dict(section):
+            raise KeyError(section)
+        monkeypatch.setattr(get_config(), "get_section_dict", failing_get_section_dict)
+        monkeypatch.setattr(utils, "_config_version", utils._config_version + 1)
+        stale_response = client.get("/areas")
+
+        assert "Warning" not in response.headers
+        assert stale_response.status_code == 200
+        assert stale_response.headers["Warning"] == '110 - "Response is Stale"'
+        assert stale_response.json() == response.json()
+        with pytest.raises(KeyError):
+            extract_config()
+
+
+# pytest -v api/tests/app/test_area.py::TestsRemoveArea
+class TestsRemoveArea:
+    """ Removal of an [Area_<n>] section when an area is deleted """
+
+    def test_remove_middle_area(self):
+        config_dict = {"App": {}, "Area_0": "a", "Area_1": "b", "Area_2": "c", "Source_0": {}}
+
+        config_dict = remove_area(config_dict, "Area_1")
+
+        assert {k: v for k, v in config_dict.items() if k.startswith("Area_")} == {"Area_0": "a", "Area_1": "c"}
+        assert "App" in config_dict and "Source_0" in config_dict
+
+    def test_remove_last_area(self):
+        config_dict = {"Area_0": "a", "Area_1": "b", "Area_2": "c"}
+
+        config_dict = remove_area(config_dict, "Area_2")
+
+        assert config_dict == {"Area_0": "a", "Area_1": "b"}
+
+    def test_remove_area_with_gap(self):
+        config_dict = {"Area_0": "a", "Area_1": "b", "Area_3": "d", "Area_4": "e"}
+
+        config_dict = remove_area(config_dict, "Area_0")
+
+        assert config_dict == {"Area_0": "b", "Area_1": "d", "Area_2": "e"}
+
+    def test_remove_area_with_gap_before(self):
+        config_dict = {"Area_1": "b", "Area_2": "c"}
+
+        config_dict = remove_area(config_dict, "Area_2")
+
+        assert config_dict == {"Area_0": "b"}
+
+    def test_remove_area_with_non_numeric_section(self):
+        config_dict = {"Area_0": "a", "Area_kitchen": "k", "Area_1": "b"}
+
+        config_dict = remove_area(config_dict, "Area_0")
+
+        assert config_dict == {"Area_0": "b", "Area_1": "k"}
+
+    def test_remove_non_numeric_area(self):
+        config_dict = {"Area_0": "a", "Area_kitchen": "k", "Area_2": "c"}
+
+        config_dict = remove_area(config_dict, "Area_kitchen")
+
+        assert config_dict == {"Area_0": "a", "Area_1": "c"}
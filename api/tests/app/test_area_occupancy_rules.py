@@ -1,5 +1,8 @@
+import asyncio
+import json
 import pytest
 import os
+import time
 from copy import deepcopy
 
 from api.utils import get_config
@@ -83,6 +86,59 @@ class TestsOccupancyRules:
 
         rollback_area_config_file(str(area_id))
 
+    def test_create_returns_occupancy_rules(self, config_rollback_areas, rollback_area_config_path):
+        area, area_2, client, config_sample_path = config_rollback_areas
+        area_id = 538
+
+        data = deepcopy(self.base_data)
+        data["id"] = area_id
+        post_response = client.post(f"/areas", json=data)
+        delete_response = client.delete(f"/areas/{area_id}")
+
+        assert post_response.status_code == 201
+        assert delete_response.status_code == 204
+        assert [r["max_occupancy"] for r in post_response.json()["occupancy_rules"]] == [12, 11]
+
+        rollback_area_config_file(str(area_id))
+
+    def test_set_overwrites_area_config_file(self, config_rollback_areas, rollback_area_config_path):
+        area, area_2, client, config_sample_path = config_rollback_areas
+        area_id = area['id']
+        config_path = get_config().get_area_config_path(area_id)
+        os.makedirs(os.path.dirname(config_path), exist_ok=True)
+        with open(config_path, "w") as area_file:
+            json.dump({"occupancy_rules": [], "unrelated_key": True}, area_file)
+
+        data = deepcopy(self.base_data)
+        data["id"] = area_id
+        response = client.put(f"/areas/{area_id}", json=data)
+
+        assert response.status_code == 200
+        assert list(read_area_config_file(area_id).keys()) == ["occupancy_rules"]
+        assert [r["max_occupancy"] for r in read_area_config_file(area_id)["occupancy_rules"]] == [12, 11]
+        assert not os.path.exists(config_path + ".tmp")
+
+    def test_delete_removes_area_config_file(self, config_rollback_areas, rollback_area_config_path):
+        area, area_2, client, config_sample_path = config_rollback_areas
+        area_id = area['id']
+
+        data = deepcopy(self.base_data)
+        data["id"] = area_id
+        set_response = client.put(f"/areas/{area_id}", json=data)
+        file_content_after_set = read_area_config_file(area_id)
+        data["occupancy_rules"] = []
+        delete_response = client.put(f"/areas/{area_id}", json=data)
+        file_content_after_delete = read_area_config_file(area_id)
+        second_delete_response = client.put(f"/areas/{area_id}", json=data)
+        delete_area_response = client.delete(f"/areas/{area_id}")
+
+        assert set_response.status_code == 200
+        assert delete_response.status_code == 200
+        assert file_content_after_set is not None
+        assert file_content_after_delete is None
+        assert second_delete_response.status_code == 200
+        assert delete_area_response.status_code == 204
+
     def test_get_not_found(self, config_rollback_areas, rollback_area_config_path):
         area, area_2, client, config_sample_path = config_rollback_areas
         area_id = 404
@@ -209,3 +265,79 @@ class TestsOccupancyRules:
         response = client.put(f"/areas/{area_id}", json=data)
 
         assert response.status_code == 400
+
+
+def area_rules(max_occupancy):
+    from api.models.occupancy_rule import OccupancyRuleListDTO
+    return OccupancyRuleListDTO.parse_obj([{
+        "days": [True, True, True, True, True, True, True],
+        "start_hour": "08:00",
+        "finish_hour": "12:00",
+        "max_occupancy": max_occupancy
+    }])
+
+
+def read_area_config_file(area_id):
+    config_path = get_config().get_area_config_path(area_id)
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, "r") as area_file:
+        return json.load(area_file)
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+# pytest -v api/tests/app/test_area_occupancy_rules.py::TestsOccupancyRulesWriter
+class TestsOccupancyRulesWriter:
+    """ Writes of the occupancy rules issued by the area endpoints """
+
+    def test_concurrent_sets_store_last_rules(self, config_rollback_areas, rollback_area_config_path):
+        from api.routers import areas
+        area, area_2, client, config_sample_path = config_rollback_areas
+        area_id = area["id"]
+
+        run(asyncio.gather(*[areas.set_occupancy_rules(area_id, area_rules(i)) for i in range(1, 6)]))
+
+        assert read_area_config_file(area_id)["occupancy_rules"][0]["max_occupancy"] == 5
+        assert area_id not in areas._pending_occupancy_rules
+        assert area_id not in areas._occupancy_rules_writers
+
+    def test_delete_during_write_leaves_no_rules(self, config_rollback_areas, rollback_area_config_path,
+                                                 monkeypatch):
+        from api.routers import areas
+        area, area_2, client, config_sample_path = config_rollback_areas
+        area_id = area["id"]
+        set_rules = areas._set_occupancy_rules
+
+        def slow_set_rules(*args):
+            time.sleep(0.2)
+            set_rules(*args)
+
+        async def set_and_delete():
+            await areas.set_occupancy_rules(area_id, area_rules(1))
+            monkeypatch.setattr(areas, "_set_occupancy_rules", slow_set_rules)
+            set_task = asyncio.ensure_future(areas.set_occupancy_rules(area_id, area_rules(2)))
+            await asyncio.sleep(0.1)
+            await areas.delete_area_occupancy_rules(area_id)
+            await set_task
+            return await areas.get_area_occupancy_rules(area_id)
+
+        assert run(set_and_delete()) == []
+        assert read_area_config_file(area_id) is None
+
+    def test_failed_write_clears_pending_rules(self, config_rollback_areas, rollback_area_config_path, monkeypatch):
+        from api.routers import areas
+        area, area_2, client, config_sample_path = config_rollback_areas
+        area_id = area["id"]
+
+        def failing_set_rules(*args):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(areas, "_set_occupancy_rules", failing_set_rules)
+        with pytest.raises(OSError):
+            run(areas.set_occupancy_rules(area_id, area_rules(1)))
+
+        assert area_id not in areas._pending_occupancy_rules
+        assert area_id not in areas._occupancy_rules_writers
@@ -17,25 +17,82 @@ def get_config():
     return Settings().config
 
 
-def extract_config(config_type="all"):
-    sections = get_config().get_sections()
-    if config_type == "cameras":
-        sections = [x for x in sections if x.startswith("Source_")]
-    elif config_type == "areas":
-        sections = [x for x in sections if x.startswith("Area_")]
-    elif config_type == "source_post_processors":
-        sections = [x for x in sections if x.startswith("SourcePostProcessor_")]
-    elif config_type == "source_loggers":
-        sections = [x for x in sections if x.startswith("SourceLogger_")]
-    elif config_type == "area_loggers":
-        sections = [x for x in sections if x.startswith("AreaLogger_")]
-    elif config_type == "periodic_tasks":
-        sections = [x for x in sections if x.startswith("PeriodicTask_")]
-    config = {}
-
-    for section in sections:
-        config[section] = get_config().get_section_dict(section)
-    return config
+AREA_SECTION_PREFIX = "Area_"
+SOURCE_SECTION_PREFIX = "Source_"
+
+CONFIG_TYPE_PREFIXES = {
+    "cameras": SOURCE_SECTION_PREFIX,
+    "areas": AREA_SECTION_PREFIX,
+    "source_post_processors": "SourcePostProcessor_",
+    "source_loggers": "SourceLogger_",
+    "area_loggers": "AreaLogger_",
+    "periodic_tasks": "PeriodicTask_",
+}
+
+# Sections of the last config read and the key they were read with. Invalidated by update_config.
+_config_version = 0
+_config_cache = (None, None)
+# Key of the last config that failed to be read, so the failure is only logged once.
+_failed_config_key = None
+
+
+def _current_config_key():
+    config = get_config()
+    try:
+        mtime = os.stat(config.config_file_path).st_mtime
+    except OSError:
+        mtime = None
+    return id(config), config.config_file_path, _config_version, mtime
+
+
+def _get_config_snapshot(allow_stale=False):
+    global _config_cache, _failed_config_key
+    key = _current_config_key()
+    cached_key, sections = _config_cache
+    if cached_key != key:
+        config = get_config()
+        try:
+            sections = {section: dict(config.get_section_dict(section)) for section in config.get_sections()}
+        except Exception:
+            # Read-only callers can keep serving the last sections read from the same ConfigEngine. Writers must
+            # not: update_config removes the Source_/Area_ sections missing from the dict it receives.
+            if not allow_stale or cached_key is None or cached_key[:2] != key[:2]:
+                raise
+            if _failed_config_key != key:
+                logger.exception("Failed to read the config, using the last version read")
+                _failed_config_key = key
+            return cached_key, sections
+        _config_cache = (key, sections)
+    return key, sections
+
+
+def config_cache_key(allow_stale=False):
+    """
+    Returns the key of the config served by extract_config. It changes whenever the config may have changed:
+    the config instance is replaced, update_config is called or the config file is modified on disk.
+    """
+    return _get_config_snapshot(allow_stale)[0]
+
+
+def config_is_stale():
+    """
+    Returns True if extract_config(allow_stale=True) is serving the last config read because the current one
+    can't be read.
+    """
+    return config_cache_key(allow_stale=True) != _current_config_key()
+
+
+def extract_config(config_type="all", allow_stale=False):
+    """
+    With allow_stale, returns the last config read if the current one can't be read instead of raising. Only
+    use it to serve reads, never for a config that will be passed to update_config.
+    """
+    prefix = CONFIG_TYPE_PREFIXES.get(config_type)
+    _, sections = _get_config_snapshot(allow_stale)
+    return {
+        section: dict(options) for section, options in sections.items()
+        if prefix is None or section.startswith(prefix)
+    }
 
 
 def restart_processor():
@@ -54,9 +111,11 @@ def restart_processor():
 
 
 def update_config(config_dict, reboot_processor):
+    global _config_version
     logger.info("Updating config...")
     get_config().update_config(config_dict)
     get_config().reload()
+    _config_version += 1
 
     if reboot_processor:
         success = restart_processor()
@@ -87,17 +146,44 @@ def handle_response(response, success, status_code=status.HTTP_200_OK, decameliz
     return JSONResponse(status_code=status_code, content=content)
 
 
+def _area_section_sort_key(area_section):
+    # Hand-edited configs may have non numeric sections (e.g. [Area_kitchen]), sort them after the numeric ones
+    suffix = area_section[len(AREA_SECTION_PREFIX):]
+    return not suffix.isdecimal(), int(suffix) if suffix.isdecimal() else 0, suffix
+
+
 def reestructure_areas(config_dict):
     """Ensure that all [Area_0, Area_1, ...] are consecutive"""
-    area_names = [x for x in config_dict.keys() if x.startswith("Area_")]
-    area_names.sort()
+    area_names = [x for x in config_dict.keys() if x.startswith(AREA_SECTION_PREFIX)]
+    area_names.sort(key=_area_section_sort_key)
     for index, area_name in enumerate(area_names):
-        if f"Area_{index}" != area_name:
-            config_dict[f"Area_{index}"] = config_dict[area_name]
+        if f"{AREA_SECTION_PREFIX}{index}" != area_name:
+            config_dict[f"{AREA_SECTION_PREFIX}{index}"] = config_dict[area_name]
             config_dict.pop(area_name)
     return config_dict
 
 
+def remove_area(config_dict, area_section):
+    """
+    Removes [Area_<n>] and shifts the following areas down, so [Area_0, Area_1, ...] remain consecutive. If the
+    areas were not consecutive to begin with (e.g. a hand-edited config), all of them are renumbered.
+    """
+    config_dict.pop(area_section)
+    removed_suffix = area_section[len(AREA_SECTION_PREFIX):]
+    if not removed_suffix.isdecimal():
+        return reestructure_areas(config_dict)
+    removed_index = int(removed_suffix)
+    area_count = sum(1 for section in config_dict if section.startswith(AREA_SECTION_PREFIX))
+    next_index = removed_index + 1
+    while f"{AREA_SECTION_PREFIX}{next_index}" in config_dict:
+        config_dict[f"{AREA_SECTION_PREFIX}{next_index - 1}"] = config_dict.pop(f"{AREA_SECTION_PREFIX}{next_index}")
+        next_index += 1
+    # [Area_0, ..., Area_<next_index - 2>] are now consecutive, any other area means there was a gap
+    if next_index - 1 != area_count or any(f"{AREA_SECTION_PREFIX}{index}" not in config_dict for index in range(removed_index)):
+        return reestructure_areas(config_dict)
+    return config_dict
+
+
 def clean_up_file(filename):
     if os.path.exists(filename):
         if os.path.isdir(filename):